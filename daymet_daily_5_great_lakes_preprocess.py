@@ -1,12 +1,18 @@
+import hashlib
+import json
 from pathlib import Path
 
 import geopandas as gpd
 import xarray as xr
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
+from affine import Affine
+from pyproj import CRS
+from rasterio.features import rasterize
 from shapely import geometry
-from shapely import vectorized  # shapely.vectorized.contains
 
 # paths
 ROOT = Path("/dkucc/home/zy166/HAB-forecasting")
@@ -15,9 +21,12 @@ GPKG = ROOT / "datasets/Lakes/shapes/lakes_greatlakes_5poly.gpkg"
 DAYMET_DIR = ROOT / "datasets/Daymet/2024_north_america_daily"
 OUT_DAYMET_DAILY = ROOT / "datasets/Daymet/daymet_glakes_daily.parquet"
 
-# lakes vector, reproject to EPSG:4326 (lat/lon)
+# cached lake label raster on the Daymet grid, plus the grid/lake signature it was built for
+LABELS_CACHE = ROOT / "datasets/Daymet/cache/daymet_lake_labels.npy"
+LABELS_CACHE_META = ROOT / "datasets/Daymet/cache/daymet_lake_labels.json"
+
+# lakes vector, reprojected to the Daymet grid CRS below
 lakes = gpd.read_file(GPKG)
-lakes = lakes.to_crs(4326)
 
 if "lake_id" not in lakes.columns:
     raise ValueError("Expect 'lake_id' in lakes_greatlakes_5poly.gpkg")
@@ -36,24 +45,176 @@ lakes = lakes[["lake_id", name_col, "geometry"]]
 
 print(lakes)
 
-# Use one file (e.g., tmin) to get the lat/lon grid.
+
+def clean_geoms(gdf: gpd.GeoDataFrame) -> list:
+    """Return the lake geometries as valid shapely objects, in `gdf` order."""
+    geoms = []
+    for geom in gdf.geometry:
+        # Some MultiPolygon / topology may have problems, buffer(0)一下
+        if not isinstance(geom, geometry.base.BaseGeometry):
+            geom = geometry.shape(geom)
+        geoms.append(geom.buffer(0))
+    return geoms
+
+
+def flatten_lake_rings(geoms: list, geom_labels: list):
+    """
+    Flatten (Multi)Polygons into the flat arrays consumed by `daymet_pip_kernel.mask_all`.
+    Rings of one lake are contiguous; holes need no flag since the even-odd
+    rule over all rings of a lake already cuts them out.
+    Returns: rings (K,2) float64, ring_offsets (R+1,) int64,
+             ring_labels (R,) int32, ring_bbox (R,4) float64 minx,miny,maxx,maxy
+    """
+    verts, offsets, ring_labels = [], [0], []
+    for geom, lab in zip(geoms, geom_labels):
+        polys = geom.geoms if geom.geom_type == "MultiPolygon" else [geom]
+        for poly in polys:
+            for ring in [poly.exterior, *poly.interiors]:
+                xy = np.asarray(ring.coords, dtype=np.float64)[:, :2]
+                verts.append(xy)
+                offsets.append(offsets[-1] + len(xy))
+                ring_labels.append(lab)
+
+    rings = np.ascontiguousarray(np.concatenate(verts))
+    ring_bbox = np.array(
+        [[v[:, 0].min(), v[:, 1].min(), v[:, 0].max(), v[:, 1].max()] for v in verts],
+        dtype=np.float64,
+    )
+    return (
+        rings,
+        np.asarray(offsets, dtype=np.int64),
+        np.asarray(ring_labels, dtype=np.int32),
+        ring_bbox,
+    )
+
+
+def label_cache_key(ds_grid: xr.Dataset, lakes: gpd.GeoDataFrame) -> dict:
+    """
+    Signature of what the label raster depends on: lake order, lake geometry (WKB hash)
+    and the grid (shape, x/y origin and step). Any change invalidates the cache.
+    """
+    x = ds_grid["x"].values
+    y = ds_grid["y"].values
+    return {
+        "lake_ids": [str(lid) for lid in lakes["lake_id"]],
+        "geometry_sha1": hashlib.sha1(b"".join(lakes.geometry.to_wkb())).hexdigest(),
+        "crs": lakes.crs.to_string() if lakes.crs is not None else None,
+        "shape": [int(len(y)), int(len(x))],
+        "x0": float(x[0]), "dx": float(x[1] - x[0]),
+        "y0": float(y[0]), "dy": float(y[1] - y[0]),
+    }
+
+
+def load_label_cache(key: dict):
+    """
+    Memory-map the cached label raster if its stored signature equals `key`.
+    Return None when there is no usable cache.
+    """
+    if not (LABELS_CACHE.exists() and LABELS_CACHE_META.exists()):
+        return None
+    with open(LABELS_CACHE_META) as f:
+        cached_key = json.load(f)
+    if cached_key != key:
+        print(f"[WARN] label cache {LABELS_CACHE} does not match the grid/lakes, rebuild it")
+        return None
+    return np.load(LABELS_CACHE, mmap_mode="r")
+
+
+# Use one file (e.g., tmin) to get the grid and its projection.
 f_grid = DAYMET_DIR / "daymet_v4_daily_na_tmin_2024.nc"
 
-# Use dask chunk to reduce the memory pressure (about 1km grid of North America)
+# Only coordinates / grid-mapping attrs are needed here, so skip dask entirely:
+# without chunks the backend stays lazy and reads just the variables we touch
+# (x/y, or lat/lon in the fallback), never the (time, y, x) cube itself.
 ds_grid = xr.open_dataset(
     f_grid,
-    chunks={"time": 365, "y": 1000, "x": 1000},
+    engine="h5netcdf",
 )
 
 print(ds_grid)
 
-# According to the Daymet documentation, there are usually `lat(y,x)` and `lon(y,x)`
-# If the names are not exactly these two, you can print ds_grid.data_vars / ds_grid.coords to see the exact names
-lat = ds_grid["lat"].values  # shape: (ny, nx)
-lon = ds_grid["lon"].values  # shape: (ny, nx)
+# Burn all lakes into one label raster: 0 = background, k = k-th lake
+# (lake_id is a string like "GL-1", so burn the position instead).
+lake_label = {lid: k for k, lid in enumerate(lakes["lake_id"], start=1)}
+
+# Daymet is on a Lambert Conformal Conic grid: `x(x)` / `y(y)` are 1D projected
+# coordinates, and the projection lives in the `lambert_conformal_conic` grid mapping.
+grid_mapping = ds_grid["tmin"].attrs.get("grid_mapping", "lambert_conformal_conic")
+
+cache_key = label_cache_key(ds_grid, lakes)
+cached_labels = load_label_cache(cache_key)
+
+if cached_labels is not None:
+    labels = cached_labels
+    ny, nx = labels.shape
+    print(f"[INFO] Daymet grid shape: ny={ny}, nx={nx}")
+    print(f"[INFO] load lake labels from cache {LABELS_CACHE}")
+elif grid_mapping in ds_grid.variables:
+    daymet_crs = CRS.from_cf(ds_grid[grid_mapping].attrs)
+
+    x = ds_grid["x"].values
+    y = ds_grid["y"].values
+    if ds_grid["x"].attrs.get("units", "m") == "km":
+        x, y = x * 1000.0, y * 1000.0
+
+    ny, nx = len(y), len(x)
+    print(f"[INFO] Daymet grid shape: ny={ny}, nx={nx}")
+
+    # Affine of the pixel corners (x/y are pixel centers; y is usually decreasing)
+    dx = x[1] - x[0]
+    dy = y[1] - y[0]
+    transform = Affine.translation(x[0] - dx / 2, y[0] - dy / 2) * Affine.scale(dx, dy)
+
+    shapes = [
+        (geom, lake_label[lid])
+        for lid, geom in zip(lakes["lake_id"], clean_geoms(lakes.to_crs(daymet_crs)))
+    ]
+
+    print(f"[INFO] rasterize {len(shapes)} lakes onto the Daymet grid ...")
+    # all_touched=False keeps the pixel-center-inside-polygon rule, so shoreline
+    # land pixels are not pulled into the lake means.
+    labels = rasterize(
+        shapes,
+        out_shape=(ny, nx),
+        transform=transform,
+        fill=0,
+        dtype="int32",
+        all_touched=False,
+    )
+else:
+    # Fallback: no projection info, so test the curvilinear `lat(y,x)` / `lon(y,x)`
+    # pixel centers against the lake polygons in EPSG:4326.
+    print(f"[WARN] grid mapping {grid_mapping!r} not found, fall back to lat/lon point-in-polygon")
+    lat = ds_grid["lat"].values  # shape: (ny, nx)
+    lon = ds_grid["lon"].values  # shape: (ny, nx)
+
+    ny, nx = lat.shape
+    print(f"[INFO] Daymet grid shape: ny={ny}, nx={nx}")
+
+    rings, ring_offsets, ring_labels, ring_bbox = flatten_lake_rings(
+        clean_geoms(lakes.to_crs(4326)),
+        [lake_label[lid] for lid in lakes["lake_id"]],
+    )
+
+    # numba is only needed on this fallback path, so import the kernel lazily
+    from daymet_pip_kernel import mask_all
 
-ny, nx = lat.shape
-print(f"[INFO] Daymet grid shape: ny={ny}, nx={nx}")
+    print(f"[INFO] point-in-polygon for {len(lake_label)} lakes ({len(ring_labels)} rings) ...")
+    labels = np.zeros(ny * nx, dtype=np.int32)
+    mask_all(
+        np.ascontiguousarray(lon, dtype=np.float64).ravel(),
+        np.ascontiguousarray(lat, dtype=np.float64).ravel(),
+        rings, ring_offsets, ring_labels, ring_bbox, labels,
+    )
+    labels = labels.reshape(ny, nx)
+
+if cached_labels is None:
+    # labels 0..K fit in int8 (K < 128 lakes): 1/4 of the int32 raster on disk
+    LABELS_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    np.save(LABELS_CACHE, labels.astype(np.int8))
+    with open(LABELS_CACHE_META, "w") as f:
+        json.dump(cache_key, f, indent=2)
+    print(f"[OK] cached lake labels → {LABELS_CACHE}")
 
 # Prepare a mask DataArray for each lake
 lake_masks = {}  # lake_id -> xr.DataArray(bool[y,x])
@@ -61,20 +222,10 @@ lake_masks = {}  # lake_id -> xr.DataArray(bool[y,x])
 for _, row in lakes.iterrows():
     lake_id   = row["lake_id"]
     lake_name = row[name_col]
-    geom      = row.geometry
-
-    # Some MultiPolygon / topology may have problems, buffer(0)一下
-    if not isinstance(geom, geometry.base.BaseGeometry):
-        geom = geometry.shape(geom)
-    geom = geom.buffer(0)
-
-    print(f"[INFO] build mask for lake {lake_id} ({lake_name}) ...")
-
-    # shapely.vectorized.contains expects (geom, x, y) = (polygon, lon, lat)
-    mask_bool = vectorized.contains(geom, lon, lat)  # shape: (ny, nx) bool
+    mask_bool = labels == lake_label[lake_id]  # shape: (ny, nx) bool
 
     if not mask_bool.any():
-        print(f"[WARN] mask for lake {lake_id} has no True pixels, check geometry/CRS")
+        print(f"[WARN] mask for lake {lake_id} ({lake_name}) has no True pixels, check geometry/CRS")
     lake_masks[lake_id] = xr.DataArray(
         mask_bool,
         dims=("y", "x"),
@@ -85,6 +236,24 @@ for _, row in lakes.iterrows():
 print(f"[OK] built masks for {len(lake_masks)} lakes")
 ds_grid.close()
 
+# The lakes cover <1% of the continental grid: crop everything to the bbox of
+# all lake pixels, so dask only reads the chunks that touch a lake.
+ys, xs = np.nonzero(labels)
+if ys.size == 0:
+    raise ValueError("No lake pixels on the Daymet grid, check geometry/CRS")
+y_slice = slice(int(ys.min()), int(ys.max()) + 1)
+x_slice = slice(int(xs.min()), int(xs.max()) + 1)
+print(f"[INFO] lake bbox on grid: y={y_slice.start}:{y_slice.stop}, x={x_slice.start}:{x_slice.stop}")
+
+# Stack all lake masks into one (lake_id, y, x) weight cube, so every variable
+# is reduced for all lakes in a single pass over the (time, y, x) data.
+lake_ids = list(lakes["lake_id"])
+lake_names = dict(zip(lakes["lake_id"], lakes[name_col]))
+masks = xr.concat(
+    [lake_masks[lid].isel(y=y_slice, x=x_slice).astype("float32") for lid in lake_ids],
+    dim=pd.Index(lake_ids, name="lake_id"),
+)
+
 
 # Map variable names to file names
 VAR_FILES = {
@@ -96,68 +265,52 @@ VAR_FILES = {
     "dayl": "daymet_v4_daily_na_dayl_2024.nc",
 }
 
-def compute_lake_daily_for_var(var_name: str) -> pd.DataFrame:
+def compute_lake_daily_for_var(var_name: str) -> xr.DataArray:
     """
     Compute the daily mean time series of each lake for a Daymet variable (e.g., tmin).
-    Return columns: ['lake_id', 'date', var_name]
+    Return a float32 DataArray named var_name with dims ('lake_id', 'time')
     """
     fpath = DAYMET_DIR / VAR_FILES[var_name]
     print(f"[INFO] open {var_name} from {fpath}")
 
+    # Open with the on-disk chunking, and only rechunk after cropping to the lake bbox
     ds = xr.open_dataset(
         fpath,
-        chunks={"time": 30, "y": 1000, "x": 1000},
+        chunks={},
     )
     # The variable name is usually the same as the file name, if not, change it here
-    da = ds[var_name]  # dims: time, y, x
+    da = ds[var_name].isel(y=y_slice, x=x_slice)  # dims: time, y, x (lake bbox only)
+    # Keep the whole time axis in one chunk, tile y/x so the stacked masks line up
+    da = da.chunk({"time": -1, "y": 500, "x": 500})
 
-    rows = []
+    print(f"[INFO] compute {var_name} daily mean for {len(lake_ids)} lakes ...")
 
-    for _, row in lakes.iterrows():
-        lake_id   = row["lake_id"]
-        lake_name = row[name_col]
-        mask_da   = lake_masks[lake_id]  # bool[y,x]
+    # NaN-aware masked mean for all lakes at once: the stacked masks are the
+    # weights, and `weighted` zeroes them at NaN pixels inside its dot products,
+    # so numerator and valid-pixel count come out of one pass per chunk.
+    series = da.weighted(masks).mean(dim=("y", "x")).compute()  # DataArray(lake_id, time)
+    # Daymet is stored as float32; keep the lake means in float32 as well
+    series = series.astype("float32")
 
-        print(f"[INFO] compute {var_name} daily mean for lake {lake_id} ({lake_name}) ...")
+    ds.close()
+    # Non-standard calendars decode to cftime; convert once on the xarray side
+    time_index = series.indexes["time"]
+    if isinstance(time_index, xr.CFTimeIndex):
+        series = series.assign_coords(time=time_index.to_datetimeindex())
 
-        # broadcast mask to (time, y, x), only keep the pixels inside the lake
-        masked = da.where(mask_da)
+    return series.rename(var_name)
 
-        # Take the mean of the spatial dimensions, get the time series
-        series = masked.mean(dim=("y", "x"), skipna=True)  # DataArray(time)
 
-        df = series.to_dataframe(name=var_name).reset_index()  # columns: ['time', var_name]
-        df["lake_id"]   = lake_id
-        df["lake_name"] = lake_name
-        rows.append(df)
+# Put all variables into one (lake_id, time) Dataset (they share the same lakes/time axis)
+lake_daily = xr.Dataset({var_name: compute_lake_daily_for_var(var_name) for var_name in VAR_FILES})
+lake_daily = lake_daily.assign_coords(lake_name=("lake_id", [lake_names[lid] for lid in lake_ids]))
 
-    ds.close()
-    out = pd.concat(rows, ignore_index=True)
-    # Use the same name for the time column: date (no timezone)
-    out["date"] = pd.to_datetime(out["time"], utc=True).dt.tz_localize(None)
-    out = out.drop(columns=["time"])
-
-    return out[["lake_id", "lake_name", "date", var_name]]
-
-
-# Get a `df` for each variable, then merge them step by step
-dfs = []
-for var_name in VAR_FILES.keys():
-    df_var = compute_lake_daily_for_var(var_name)
-    dfs.append(df_var)
-
-# Use the first variable as the base, then merge with other variables step by step
-from functools import reduce
-
-df_daymet = reduce(
-    lambda left, right: pd.merge(
-        left,
-        right,
-        on=["lake_id", "lake_name", "date"],
-        how="outer",
-    ),
-    dfs,
-)
+# Convert to a flat table exactly once; lake_name comes along as a coordinate column
+df_daymet = lake_daily.to_dataframe().reset_index()
+# Use the same name for the time column: date (xarray times are already tz-naive)
+df_daymet = df_daymet.rename(columns={"time": "date"})
+df_daymet["date"] = np.asarray(df_daymet["date"], dtype="datetime64[ns]")
+df_daymet = df_daymet[["lake_id", "lake_name", "date", *VAR_FILES]]
 
 # Sort it for better readability
 df_daymet = df_daymet.sort_values(["lake_id", "date"]).reset_index(drop=True)
@@ -165,7 +318,15 @@ df_daymet = df_daymet.sort_values(["lake_id", "date"]).reset_index(drop=True)
 print(df_daymet.head())
 print(df_daymet.describe(include="all"))
 
-# Save as parquet
+# Save as parquet (the variable columns are float32, as computed)
 OUT_DAYMET_DAILY.parent.mkdir(parents=True, exist_ok=True)
-df_daymet.to_parquet(OUT_DAYMET_DAILY, index=False)
-print(f"[OK] saved daily lake-mean Daymet → {OUT_DAYMET_DAILY}, rows={len(df_daymet)}")
\ No newline at end of file
+# zstd + row groups over the (lake_id, date)-sorted rows for predicate pushdown downstream
+pq.write_table(
+    pa.Table.from_pandas(df_daymet, preserve_index=False),
+    OUT_DAYMET_DAILY,
+    compression="zstd",
+    compression_level=3,
+    row_group_size=100_000,
+    use_dictionary=["lake_id", "lake_name"],
+)
+print(f"[OK] saved daily lake-mean Daymet → {OUT_DAYMET_DAILY}, rows={len(df_daymet)}")
@@ -0,0 +1,45 @@
+"""
+Numba point-in-polygon kernel for the Daymet lake masks.
+
+Only used by daymet_daily_5_great_lakes_preprocess.py when the grid has no
+projection info (curvilinear lat/lon fallback); kept in its own module so the
+normal rasterize path does not import numba.
+"""
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def mask_all(lon, lat, rings, ring_offsets, ring_labels, ring_bbox, out_labels):
+    """
+    Crossing-number (ray casting) point-in-polygon for all lakes in one pass.
+    Writes the label of the lake containing each (lon[i], lat[i]) into out_labels[i];
+    pixels outside every lake are left untouched.
+    """
+    n_rings = ring_labels.shape[0]
+    for i in prange(lon.shape[0]):
+        px = lon[i]
+        py = lat[i]
+        r = 0
+        while r < n_rings:
+            lab = ring_labels[r]
+            inside = False
+            while r < n_rings and ring_labels[r] == lab:
+                # a point outside the ring bbox crosses it an even number of times
+                if (ring_bbox[r, 0] <= px <= ring_bbox[r, 2]
+                        and ring_bbox[r, 1] <= py <= ring_bbox[r, 3]):
+                    start = ring_offsets[r]
+                    end = ring_offsets[r + 1]
+                    j = end - 1
+                    for k in range(start, end):
+                        x1, y1 = rings[j, 0], rings[j, 1]
+                        x2, y2 = rings[k, 0], rings[k, 1]
+                        if (y1 > py) != (y2 > py):
+                            x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+                            if px < x_cross:
+                                inside = not inside
+                        j = k
+                r += 1
+            if inside:
+                out_labels[i] = lab
+                break
+
@@ -1,10 +1,13 @@
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import numpy as np
 import pandas as pd
 import xarray as xr
 import geopandas as gpd
 import rioxarray  # NOTE: currently not used in clipping, but kept for future use
+import shapely
 import time
 
 def infer_time_label(nc_path, ds, product="monthly"):
@@ -53,43 +56,107 @@ def infer_time_label(nc_path, ds, product="monthly"):
 
     raise ValueError("Cannot infer time from dataset or filename: " + fn)
 
-def clean_ci(da: xr.DataArray) -> xr.DataArray:
+def clean_ci(da: xr.DataArray) -> np.ndarray:
     """
     Filter out values out of physical range and remove near-zero values.
+    All conditions are fused into one boolean mask over the raw array (a single pass);
+    returns a plain ndarray with invalid pixels set to NaN.
     """
     vmin = float(da.attrs.get("valid_min", np.nan))
     vmax = float(da.attrs.get("valid_max", np.nan))
+    # drop near-zero (background) CI
+    thr = max(vmin, 5e-5) if np.isfinite(vmin) else 5e-5
+
+    arr = np.asarray(da.values)
+    valid = arr > thr
     if np.isfinite(vmin):
-        da = da.where(da >= vmin)
+        valid &= arr >= vmin
     if np.isfinite(vmax):
-        da = da.where(da <= vmax)
+        valid &= arr <= vmax
 
-    # drop near-zero (background) CI
-    thr = max(vmin, 5e-5) if np.isfinite(vmin) else 5e-5
-    da = da.where(da > thr)
+    return np.where(valid, arr, np.nan)
+
+def quantile_select(vals: np.ndarray, q: float) -> float:
+    """
+    与 np.quantile(vals, q)（默认线性插值）结果一致，但用 np.partition 做 O(n) 选择而非排序。
+    vals 需已去掉 NaN（调用方只传入 finite 像元）。
+    """
+    pos = q * (vals.size - 1)
+    lo = int(pos)
+    hi = min(lo + 1, vals.size - 1)
+    part = np.partition(vals, [lo, hi])
+    return float(part[lo] + (pos - lo) * (part[hi] - part[lo]))
+
+def build_lake_labels(lat: np.ndarray,
+                      lon: np.ndarray,
+                      bboxes: np.ndarray,
+                      geoms: np.ndarray | None = None) -> np.ndarray:
+    """
+    把所有湖一次性写进一个 int16 标签图：0 = 背景，k = bboxes 第 k 行 (从 1 开始)。
+    先用 bbox 初筛；若给了 geoms（湖泊多边形），再只对 bbox 内的像元
+    做真正的点在多边形内判断。重叠像素归属于排在前面的湖（每个像素只属于一个湖，便于 bincount）。
+    bboxes: (K, 4) float，每行 minx, miny, maxx, maxy (经度, 纬度)
+    """
+    labels = np.zeros(lat.shape, dtype=np.int16)
+    if geoms is not None:
+        # 原地 prepare（已 prepare 的几何会直接跳过）；prepare 状态不随 pickle 传给 worker，所以在这里做
+        shapely.prepare(geoms)
+    for k in range(len(bboxes)):
+        minx, miny, maxx, maxy = bboxes[k]
+        mask = (
+            (lon >= minx) & (lon <= maxx) &
+            (lat >= miny) & (lat <= maxy)
+        )
+        mask &= labels == 0
+        if geoms is None:
+            labels[mask] = k + 1
+            continue
 
-    return da
+        idx = np.flatnonzero(mask)
+        inside = shapely.contains_xy(geoms[k], lon.ravel()[idx], lat.ravel()[idx])
+        labels.ravel()[idx[inside]] = k + 1
+    return labels
+
+# 标签图只取决于固定的 lat/lon 网格与湖泊几何：每个进程内按网格 shape 缓存，所有文件复用
+_LABELS_CACHE = {}
+
+def get_lake_labels(lat: xr.DataArray,
+                    lon: xr.DataArray,
+                    bboxes: np.ndarray,
+                    geoms: np.ndarray | None = None) -> np.ndarray:
+    """
+    返回该网格的湖泊标签图；同一 shape（与同一组湖）只在第一次调用时读取 lat/lon 并构建，
+    之后直接复用，既省去 bbox 扫描与多边形判断，也不再重复读 lat/lon。
+    """
+    key = (lat.shape, bboxes.tobytes(), geoms is not None)
+    labels = _LABELS_CACHE.get(key)
+    if labels is None:
+        labels = build_lake_labels(np.asarray(lat.values), np.asarray(lon.values), bboxes, geoms)
+        _LABELS_CACHE[key] = labels
+    return labels
 
 def _extract_lakes_core_from_ds(
     ds: xr.Dataset,
     nc_path: str,
-    lakes_gdf: gpd.GeoDataFrame,
-    lake_id_col: str,
+    lake_ids: np.ndarray,
+    bboxes: np.ndarray,
     product: str,
     time_label: pd.Timestamp,
     engine: str,
+    geoms: np.ndarray | None = None,
 ) -> pd.DataFrame:
     """
-    核心提取逻辑：针对一个 xarray.Dataset，用 lat/lon + bbox 做掩膜裁剪 CI_cyano。
-    兼容曲线网格(lat(y,x), lon(y,x))。
+    核心提取逻辑：针对一个 xarray.Dataset，用 lat/lon + bbox（可选再加多边形）做掩膜裁剪 CI_cyano。
+    兼容曲线网格(lat(y,x), lon(y,x))。所有湖共用一个标签图，一次 bincount 完成统计。
+    lake_ids: (K,) 湖泊 id；bboxes: (K, 4) minx, miny, maxx, maxy，均在文件循环外预先算好。
+    geoms: 可选，K 个湖泊多边形；为 None 时只用 bbox。
     返回列：
       lake_id, time, product, CI_mean, CI_p90, n_valid, src, engine
     """
     if "CI_cyano" not in ds.data_vars:
         raise KeyError("CI_cyano not found in dataset data_vars")
 
-    da = ds["CI_cyano"]
-    da = clean_ci(da)
+    ci = clean_ci(ds["CI_cyano"])
 
     # 期望 lat, lon 是 2D (y,x)，与 CI_cyano 维度一致
     if "lat" not in ds.variables or "lon" not in ds.variables:
@@ -98,56 +165,60 @@ def _extract_lakes_core_from_ds(
     lat = ds["lat"]
     lon = ds["lon"]
 
-    if lat.shape != da.shape or lon.shape != da.shape:
+    if lat.shape != ci.shape or lon.shape != ci.shape:
         # 极端情况下可以做广播，但对 ILW_CONUS 来说应该是一致的
         raise ValueError(
-            f"lat/lon shape {lat.shape}/{lon.shape} not matching CI_cyano {da.shape}"
-        )
-
-    rows = []
-    for _, r in lakes_gdf.iterrows():
-        lid = r[lake_id_col]
-        geom = r.geometry
-        minx, miny, maxx, maxy = geom.bounds  # 经度, 纬度
-
-        # 使用 bbox 对 lat/lon 作初筛
-        mask = (
-            (lon >= minx) & (lon <= maxx) &
-            (lat >= miny) & (lat <= maxy)
+            f"lat/lon shape {lat.shape}/{lon.shape} not matching CI_cyano {ci.shape}"
         )
 
-        sub = da.where(mask)
-        arr = np.asarray(sub.values)
-        finite = np.isfinite(arr)
-        n_valid = int(finite.sum())
-
-        if n_valid > 0:
-            vals = arr[finite].ravel()
-            mean_val = float(np.nanmean(vals))
-            p90      = float(np.nanquantile(vals, 0.9))
-        else:
-            mean_val, p90 = np.nan, np.nan
-
-        rows.append({
-            "lake_id": lid,
-            "time":   pd.to_datetime(time_label),
-            "product": product,
-            "CI_mean": mean_val,
-            "CI_p90":  p90,
-            "n_valid": n_valid,
-            "src":     Path(nc_path).name,
-            "engine":  engine,
-        })
-
-    return pd.DataFrame(rows)
+    K = len(lake_ids)
+    labels = get_lake_labels(lat, lon, bboxes, geoms)
+
+    # 只取湖内有效像元（远少于整张 CONUS 网格），后续 bincount / 排序都只在这部分上做
+    lab = labels.ravel()
+    v = ci.ravel()
+    sel = (lab > 0) & np.isfinite(v)
+    lab_in = lab[sel]
+    v_in = v[sel]
+
+    # 按标签分组求有效像元数与和
+    counts = np.bincount(lab_in, minlength=K + 1)
+    sums = np.bincount(lab_in, weights=v_in, minlength=K + 1)
+
+    # p90：按标签排序后切分成 K 组
+    order = np.argsort(lab_in, kind="stable")
+    split_idx = np.searchsorted(lab_in[order], np.arange(2, K + 1))
+    per_lake_vals = np.split(v_in[order], split_idx)  # per_lake_vals[k] -> lake_ids[k]
+
+    # CI 统计量用 float32 存储即可（减半内存与 parquet 体积）
+    means    = np.full(K, np.nan, dtype=np.float32)
+    p90s     = np.full(K, np.nan, dtype=np.float32)
+    n_valids = counts[1:].astype(np.int64)
+    for k in range(K):
+        if n_valids[k] > 0:
+            means[k] = sums[k + 1] / counts[k + 1]
+            p90s[k]  = quantile_select(per_lake_vals[k], 0.9)
+
+    return pd.DataFrame({
+        "lake_id": lake_ids,
+        "time":    pd.to_datetime(time_label),
+        "product": product,
+        "CI_mean": means,
+        "CI_p90":  p90s,
+        "n_valid": n_valids,
+        "src":     Path(nc_path).name,
+        "engine":  engine,
+    })
 
 def extract_lakes_from_nc(nc_path: str,
-                          lakes_gdf: gpd.GeoDataFrame,
-                          lake_id_col: str,
-                          product: str) -> pd.DataFrame:
+                          lake_ids: np.ndarray,
+                          bboxes: np.ndarray,
+                          product: str,
+                          geoms: np.ndarray | None = None) -> pd.DataFrame:
     """
     nc_path: A single NetCDF file (S3B monthly or S3M daily)
-    lakes_gdf: A GeoDataFrame containing `lake_id` and `geometry` (EPSG:4326)
+    lake_ids: (K,) lake ids; bboxes: (K, 4) minx, miny, maxx, maxy of each lake (EPSG:4326)
+    geoms: Optional lake polygons; if given, pixels must fall inside the polygon
     product: 'monthly' | 'daily'
     Returns: One row per lake (timestamp of the file)
     """
@@ -157,11 +228,12 @@ def extract_lakes_from_nc(nc_path: str,
         df = _extract_lakes_core_from_ds(
             ds=ds,
             nc_path=nc_path,
-            lakes_gdf=lakes_gdf,
-            lake_id_col=lake_id_col,
+            lake_ids=lake_ids,
+            bboxes=bboxes,
             product=product,
             time_label=t,
             engine="netcdf4",
+            geoms=geoms,
         )
     return df
 
@@ -239,12 +311,13 @@ def looks_like_hdf5(path: Path) -> bool:
         return False
 
 def _extract_one_with_h5netcdf(nc_path: Path,
-                               lakes_gdf: gpd.GeoDataFrame,
-                               lake_id_col: str,
-                               product: str = "daily") -> pd.DataFrame:
+                               lake_ids: np.ndarray,
+                               bboxes: np.ndarray,
+                               product: str = "daily",
+                               geoms: np.ndarray | None = None) -> pd.DataFrame:
     """
     兜底方案：用 h5netcdf 打开并在本函数内完成裁剪与统计。
-    现在同样使用 lat/lon + bbox 掩膜，不再调用 rioxarray.clip。
+    现在同样使用 lat/lon + bbox（+ 可选多边形）掩膜，不再调用 rioxarray.clip。
     返回列同 extract_lakes_from_nc：
       lake_id, time, product, CI_mean, CI_p90, n_valid, src, engine
     """
@@ -254,11 +327,12 @@ def _extract_one_with_h5netcdf(nc_path: Path,
         df = _extract_lakes_core_from_ds(
             ds=ds,
             nc_path=str(nc_path),
-            lakes_gdf=lakes_gdf,
-            lake_id_col=lake_id_col,
+            lake_ids=lake_ids,
+            bboxes=bboxes,
             product=product,
             time_label=t,
             engine="h5netcdf",
+            geoms=geoms,
         )
     return df
 
@@ -317,12 +391,102 @@ def _log_one_file(df_one, fp_name, engine, t0):
     )
 
 
+# 输出 parquet 的列顺序与 row group 行数
+DAILY_COLS = ["lake_id", "date", "product", "CI_mean", "CI_p90", "n_valid", "src", "engine"]
+ROW_GROUP_SIZE = 100_000
+
+def _normalize_daily_cols(df_one: pd.DataFrame) -> pd.DataFrame:
+    """补齐缺失列并按 DAILY_COLS 排列，保证每个文件写出的 schema 一致。"""
+    for c in DAILY_COLS:
+        if c not in df_one.columns:
+            # lake_id/product/src/engine 用 None，其余用 NaN
+            df_one[c] = np.nan if c not in ("lake_id", "product", "src", "engine") else None
+    return df_one[DAILY_COLS]
+
+# 每个 worker 进程内的湖泊 id、bbox 与多边形（由 _init_worker 设置一次，避免每个任务重复 pickle）
+_WORKER_LAKE_IDS = None
+_WORKER_BBOXES = None
+_WORKER_GEOMS = None
+
+def _init_worker(lake_ids: np.ndarray, bboxes: np.ndarray, geoms: np.ndarray):
+    global _WORKER_LAKE_IDS, _WORKER_BBOXES, _WORKER_GEOMS
+    _WORKER_LAKE_IDS = lake_ids
+    _WORKER_BBOXES = bboxes
+    _WORKER_GEOMS = geoms
+
+def _process_one(fp: Path) -> pd.DataFrame | None:
+    """
+    处理单个 daily nc 文件：netcdf4 → h5netcdf 兜底。
+    在 worker 进程中运行，湖泊数据取自 _init_worker 设置的全局变量。
+    返回该文件的结果 DataFrame，失败/跳过时返回 None。
+    """
+    lake_ids, bboxes, geoms = _WORKER_LAKE_IDS, _WORKER_BBOXES, _WORKER_GEOMS
+    t0 = time.time()
+    print(f"[daily] start {fp.name}", flush=True)
+
+    # 1) 文件头快速校验
+    if not looks_like_hdf5(fp):
+        print(f"[WARN] Skip (not HDF5/NetCDF header): {fp.name}")
+        return None
+
+    # 2) 首选：netcdf4 引擎
+    try:
+        df_one = extract_lakes_from_nc(str(fp), lake_ids, bboxes, product="daily",
+                                       geoms=geoms)
+        # 统一列名为 date
+        if "time" in df_one.columns and "date" not in df_one.columns:
+            df_one = df_one.rename(columns={"time": "date"})
+        df_one["src"] = fp.name
+        df_one["engine"] = "netcdf4"
+        _log_one_file(df_one, fp.name, "netcdf4", t0)
+        return df_one
+    except Exception as e1:
+        print(f"[WARN] netcdf4 failed on {fp.name}: {e1}")
+
+    # 3) 兜底：h5netcdf 内联提取
+    try:
+        df_one = _extract_one_with_h5netcdf(fp, lake_ids, bboxes, product="daily",
+                                            geoms=geoms)
+        if "time" in df_one.columns and "date" not in df_one.columns:
+            df_one = df_one.rename(columns={"time": "date"})
+        df_one["src"] = fp.name
+        df_one["engine"] = "h5netcdf"
+        _log_one_file(df_one, fp.name, "h5netcdf", t0)
+        return df_one
+    except Exception as e2:
+        print(f"[SKIP] {fp.name}: h5netcdf fallback failed → {e2}")
+        return None
+
+
+# 单个 worker 处理一个 CONUS daily 文件 (~15138x26328 ≈ 4 亿像元) 时的峰值内存估计 (GB)：
+# lat/lon、CI 及清洗后的副本、int16 标签图、bbox 布尔临时数组等合计 >10 GB
+WORKER_MEM_GB = 12
+
+def _default_max_workers() -> int:
+    """按可用 CPU 与可用内存 / WORKER_MEM_GB 取较小者，至少 1 个 worker。"""
+    if hasattr(os, "sched_getaffinity"):
+        n_cpu = len(os.sched_getaffinity(0))
+    else:
+        n_cpu = os.cpu_count() or 1
+    try:
+        avail_gb = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**3
+    except (ValueError, OSError, AttributeError):
+        # 无法获取可用内存时保守地退回单进程（与原先逐个文件处理一致）
+        return 1
+    return max(1, min(n_cpu, int(avail_gb // WORKER_MEM_GB)))
+
 def run_daily(daily_dir: str,
               lakes_fp: str,
               lake_id_col: str,
-              out_parquet: str):
+              out_parquet: str,
+              max_workers: int | None = None):
     """
     daily_dir: Directory containing files like S3M_OLCI_EFRNT.*.L3m.DAY.ILW_CONUS...nc
+    max_workers: Number of worker processes (one file per task).
+                 Each worker peaks at roughly WORKER_MEM_GB (~12 GB) on a CONUS daily file
+                 (lat/lon grids, CI + cleaned copy, label array, bbox temporaries), so the
+                 default is min(usable CPUs, available memory // WORKER_MEM_GB), at least 1.
+                 Set it explicitly on shared nodes to stay within your memory allocation.
     """
     daily_dir = Path(daily_dir)
     gdf = gpd.read_file(lakes_fp)
@@ -330,64 +494,56 @@ def run_daily(daily_dir: str,
         raise ValueError("The lake file is missing CRS, please ensure it is EPSG:4326")
     gdf = gdf.to_crs(4326)[[lake_id_col, "geometry"]].dropna()
 
-    out_rows = []
+    # 在文件循环外一次性取出 id、bbox 与多边形，热路径中不再 iterrows / 调用 geom.bounds
+    lake_ids = gdf[lake_id_col].to_numpy()
+    # 与 Daymet 脚本一致：buffer(0) 修复可能无效的 (Multi)Polygon，避免 contains 在每个文件上都报错被跳过
+    geoms = np.array([g.buffer(0) for g in gdf.geometry], dtype=object)
+    bboxes = shapely.bounds(geoms)  # (K, 4) minx, miny, maxx, maxy
+
     files = sorted(daily_dir.glob("S3M_OLCI_EFRNT.*.L3m.DAY.*.nc"))
     if not files:
         print(f"[WARN] No daily files found under: {daily_dir}")
         return
 
-    print(f"[daily] found {len(files)} files under {daily_dir}")
-    for fp in files:
-        t0 = time.time()
-        print(f"[daily] start {fp.name}", flush=True)
-
-        # 1) 文件头快速校验
-        if not looks_like_hdf5(fp):
-            print(f"[WARN] Skip (not HDF5/NetCDF header): {fp.name}")
-            continue
-
-        # 2) 首选：netcdf4 引擎
-        try:
-            df_one = extract_lakes_from_nc(str(fp), gdf, lake_id_col, product="daily")
-            # 统一列名为 date
-            if "time" in df_one.columns and "date" not in df_one.columns:
-                df_one = df_one.rename(columns={"time": "date"})
-            df_one["src"] = fp.name
-            df_one["engine"] = "netcdf4"
-            out_rows.append(df_one)
-            _log_one_file(df_one, fp.name, "netcdf4", t0)
-            continue
-        except Exception as e1:
-            print(f"[WARN] netcdf4 failed on {fp.name}: {e1}")
+    max_workers = max_workers or _default_max_workers()
+    print(f"[daily] found {len(files)} files under {daily_dir} (workers={max_workers})")
 
-        # 3) 兜底：h5netcdf 内联提取
-        try:
-            df_one = _extract_one_with_h5netcdf(fp, gdf, lake_id_col, product="daily")
-            if "time" in df_one.columns and "date" not in df_one.columns:
-                df_one = df_one.rename(columns={"time": "date"})
-            df_one["src"] = fp.name
-            df_one["engine"] = "h5netcdf"
-            out_rows.append(df_one)
-            _log_one_file(df_one, fp.name, "h5netcdf", t0)
-        except Exception as e2:
-            print(f"[SKIP] {fp.name}: h5netcdf fallback failed → {e2}")
+    # 每个文件相互独立：按文件粒度并行，湖泊数据只在每个 worker 启动时传一次。
+    # 每个文件只产出 K(=5) 行，一整年也不过 ~1.8k 行，因此这里不做流式写出：
+    # 全部结果留在内存里，最后一次 concat + 全局排序，保证输出按 (lake_id, date) 有序。
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(lake_ids, bboxes, geoms),
+    ) as ex:
+        out_rows = [_normalize_daily_cols(df) for df in ex.map(_process_one, files) if df is not None]
 
     if not out_rows:
         print("No valid daily rows produced.")
         return
 
     df_all = pd.concat(out_rows, ignore_index=True)
+    df_all = df_all.sort_values(["lake_id", "date"]).reset_index(drop=True)
 
-    # 基本整理：日期排序、列顺序、小型诊断
-    keep_cols = ["lake_id", "date", "product", "CI_mean", "CI_p90", "n_valid", "src", "engine"]
-    for c in keep_cols:
-        if c not in df_all.columns:
-            # lake_id/product/src/engine 用 None，其余用 NaN
-            df_all[c] = np.nan if c not in ("lake_id", "product", "src", "engine") else None
-    df_all = df_all[keep_cols].sort_values(["lake_id", "date"]).reset_index(drop=True)
-
-    Path(out_parquet).parent.mkdir(parents=True, exist_ok=True)
-    df_all.to_parquet(out_parquet, index=False)
+    out_parquet = Path(out_parquet)
+    out_parquet.parent.mkdir(parents=True, exist_ok=True)
+    # 先写临时文件，成功后再替换；失败时删除临时文件，避免留下半个 parquet
+    tmp_parquet = out_parquet.with_name(out_parquet.name + ".tmp")
+    try:
+        # zstd + row groups over the (lake_id, date)-sorted rows for predicate pushdown downstream
+        df_all.to_parquet(
+            tmp_parquet,
+            engine="pyarrow",
+            compression="zstd",
+            compression_level=3,
+            row_group_size=ROW_GROUP_SIZE,
+            use_dictionary=["lake_id", "product", "src", "engine"],
+            index=False,
+        )
+        os.replace(tmp_parquet, out_parquet)
+    except BaseException:
+        tmp_parquet.unlink(missing_ok=True)
+        raise
     print(f"[daily] saved → {out_parquet}  (rows={len(df_all)}, files={len(files)})", flush=True)
 
 